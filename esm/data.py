@@ -3,6 +3,7 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 
+import collections
 import os
 import pickle
 import re
@@ -50,6 +51,20 @@ class FastaBatchedDataset(object):
 
         return cls(sequence_labels, sequence_strs)
 
+    @classmethod
+    def from_files(cls, fasta_files):
+        sequence_labels, sequence_strs = [], []
+        for fasta_file in fasta_files:
+            dataset = cls.from_file(fasta_file)
+            sequence_labels.extend(dataset.sequence_labels)
+            sequence_strs.extend(dataset.sequence_strs)
+
+        counts = collections.Counter(sequence_labels)
+        duplicates = sorted(label for label, count in counts.items() if count > 1)
+        assert not duplicates, f"Duplicate sequence labels across FASTA files: {duplicates}"
+
+        return cls(sequence_labels, sequence_strs)
+
     def __len__(self):
         return len(self.sequence_labels)
 
@@ -57,6 +72,7 @@ class FastaBatchedDataset(object):
         return self.sequence_labels[idx], self.sequence_strs[idx]
 
     def get_batch_indices(self, toks_per_batch, extra_toks_per_seq=0):
+        # Sort by length so each batch holds similar-length sequences and padding is minimal
         sizes = [(len(s), i) for i, s in enumerate(self.sequence_strs)]
         sizes.sort()
         batches = []
@@ -101,7 +101,14 @@ class ProteinBertModel(nn.Module):
         if self.args.final_bias:
             self.embed_out_bias = nn.Parameter(torch.zeros(self.alphabet_size))
 
-    def forward(self, tokens, repr_layers=[], need_head_weights=False, return_contacts=False):
+    def forward(
+        self,
+        tokens,
+        repr_layers=[],
+        need_head_weights=False,
+        return_contacts=False,
+        return_logits=True,
+    ):
         if return_contacts:
             need_head_weights = True
 
@@ -116,7 +123,7 @@ class ProteinBertModel(nn.Module):
             mask_ratio_train = 0.15 * 0.8
             src_lengths = (~padding_mask).sum(-1)
             mask_ratio_observed = (tokens == self.mask_idx).sum(-1).float() / src_lengths
-            x = x * (1 - mask_ratio_train) / (1 - mask_ratio_observed)[:, None, None]
+            x = x * (1 - mask_ratio_train) / (1 - mask_ratio_observed.to(x.dtype))[:, None, None]
 
         x = x + self.embed_positions(tokens)
 
@@ -136,9 +143,8 @@ class ProteinBertModel(nn.Module):
         # (B, T, E) => (T, B, E)
         x = x.transpose(0, 1)
 
-        if not padding_mask.any():
-            padding_mask = None
-
+        # padding_mask is always passed, even when nothing is padded: checking
+        # padding_mask.any() would read a device value back and stall the host
         for layer_idx, layer in enumerate(self.layers):
             x, attn = layer(x, self_attn_padding_mask=padding_mask, need_head_weights=need_head_weights)
             if (layer_idx + 1) in repr_layers:
@@ -154,12 +160,16 @@ class ProteinBertModel(nn.Module):
             # last hidden representation should have layer norm applied
             if (layer_idx + 1) in repr_layers:
                 hidden_representations[layer_idx + 1] = x
-            x = self.lm_head(x)
-        else:
+            if return_logits:
+                x = self.lm_head(x)
+        elif return_logits:
             x = F.linear(x, self.embed_out, bias=self.embed_out_bias)
             x = x.transpose(0, 1) # (T, B, E) => (B, T, E)
 
-        result = {"logits": x, "representations": hidden_representations}
+        result = {}
+        if return_logits:
+            result["logits"] = x
+        result["representations"] = hidden_representations
         if need_head_weights:
             # attentions: B x L x H x T x T
             attentions = torch.stack(attn_weights, 1)
@@ -192,7 +202,7 @@ class ProteinBertModel(nn.Module):
         return self.contact_head(attentions)
 
     def predict_contacts(self, tokens):
-        return self(tokens, return_contacts=True)["contacts"]
+        return self(tokens, return_contacts=True, return_logits=False)["contacts"]
 
     @property
     def num_layers(self):
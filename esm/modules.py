@@ -52,10 +52,13 @@ class ESM1LayerNorm(nn.Module):
 
     def forward(self, x):
         dims = tuple(-(i + 1) for i in range(len(self.hidden_size)))
-        means = x.mean(dims, keepdim=True)
-        x_zeromean = x - means
+        # Statistics are computed in float32: in half precision eps rounds to 0, so an all-zero
+        # (padding) row would normalize to 0 / 0
+        x_float = x.float()
+        means = x_float.mean(dims, keepdim=True)
+        x_zeromean = x_float - means
         variances = x_zeromean.pow(2).mean(dims, keepdim=True)
-        x = x_zeromean / torch.sqrt(variances + self.eps)
+        x = (x_zeromean / torch.sqrt(variances + self.eps)).type_as(x)
         if self.affine:
             x = (self.weight * x) + self.bias
         return x
@@ -5,11 +5,14 @@
 # LICENSE file in the root directory of this source tree.
 
 import argparse
+import collections
+import concurrent.futures
 import pathlib
 
 import torch
 
 from esm import Alphabet, FastaBatchedDataset, ProteinBertModel, pretrained
+from esm.multihead_attention import MultiheadAttention
 
 
 def create_parser():
@@ -36,6 +39,12 @@ def create_parser():
     parser.add_argument(
         "--toks_per_batch", type=int, default=4096, help="maximum batch size"
     )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=4,
+        help="number of DataLoader worker processes used to tokenize batches",
+    )
     parser.add_argument(
         "--repr_layers",
         type=int,
@@ -52,25 +61,81 @@ def create_parser():
         required=True
     )
 
+    parser.add_argument(
+        "--shards",
+        action="store_true",
+        help="save one file per batch, keyed by sequence label, instead of one file per sequence",
+    )
+
     parser.add_argument("--nogpu", action="store_true", help="Do not use GPU even if available")
+    parser.add_argument(
+        "--fp16", action="store_true", help="Run the model in half precision (GPU only)"
+    )
+    parser.add_argument(
+        "--int8",
+        action="store_true",
+        help="Dynamically quantize the transformer layers to int8 (CPU only)",
+    )
+    parser.add_argument(
+        "--compile", action="store_true", help="Compile the model with torch.compile"
+    )
     return parser
 
 
+# Batches whose saves may still be in flight before the main loop waits for the oldest one
+MAX_PENDING_SAVE_BATCHES = 2
+
+
+def _to_host(outputs):
+    # Non-blocking copies into pinned host memory; wait on the copy stream before reading them
+    if isinstance(outputs, dict):
+        return {k: _to_host(v) for k, v in outputs.items()}
+    if isinstance(outputs, list):
+        return [_to_host(v) for v in outputs]
+    return outputs.to(device="cpu", non_blocking=True)
+
+
 def main(args):
     model, alphabet = pretrained.load_model_and_alphabet(args.model_location)
     model.eval()
     if torch.cuda.is_available() and not args.nogpu:
         model = model.cuda()
         print("Transferred model to GPU")
+        if args.fp16:
+            model = model.half()
+    elif args.int8:
+        # The fused attention path reads .weight off the projections, which quantized Linear
+        # modules don't expose as tensors, so use the unfused path instead
+        for module in model.modules():
+            if isinstance(module, MultiheadAttention):
+                module.enable_torch_version = False
+        # Only the transformer layers are quantized; the contact head reads its parameters' dtype
+        model.layers = torch.quantization.quantize_dynamic(
+            model.layers, {torch.nn.Linear}, dtype=torch.qint8
+        )
+        print("Quantized model to int8")
+    if args.compile:
+        # dynamic=True keeps the number of recompiles bounded across batch shapes. CUDA graphs
+        # (mode="reduce-overhead") are not used: they reuse output memory on the next forward
+        # pass, which would race with the overlapped copy of the previous batch's outputs.
+        model = torch.compile(model, dynamic=True)
 
     dataset = FastaBatchedDataset.from_file(args.fasta_file)
-    batches = dataset.get_batch_indices(args.toks_per_batch, extra_toks_per_seq=1)
+    extra_toks_per_seq = int(alphabet.prepend_bos) + int(alphabet.append_eos)
+    batches = dataset.get_batch_indices(args.toks_per_batch, extra_toks_per_seq=extra_toks_per_seq)
+    # Pinned batches let the non_blocking host to device copy below run asynchronously
     data_loader = torch.utils.data.DataLoader(
-        dataset, collate_fn=alphabet.get_batch_converter(), batch_sampler=batches
+        dataset,
+        collate_fn=alphabet.get_batch_converter(),
+        batch_sampler=batches,
+        num_workers=args.num_workers,
+        pin_memory=torch.cuda.is_available() and not args.nogpu,
     )
     print(f"Read {args.fasta_file} with {len(dataset)} sequences")
 
     args.output_dir.mkdir(parents=True, exist_ok=True)
+    # Labels containing "/" write into subdirectories; create each of those only once
+    created_dirs = {args.output_dir}
     return_contacts = "contacts" in args.include
 
     assert all(
@@ -79,8 +144,65 @@ def main(args):
     repr_layers = [
         (i + model.num_layers + 1) % (model.num_layers + 1) for i in args.repr_layers
     ]
+    # Stacked representations are indexed in this order, which is also the model's output order
+    layers = sorted(set(repr_layers))
+
+    # Saves run on background threads so disk writes overlap with the next forward pass
+    writer = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+    # Futures grouped per batch. Waiting on the oldest batches bounds the host memory held by
+    # queued saves when disk falls behind and re-raises write errors as soon as they happen.
+    pending_saves = collections.deque()
+    # Device to host copies run on a side stream so they overlap with the next forward pass
+    copy_stream = torch.cuda.Stream() if torch.cuda.is_available() and not args.nogpu else None
+
+    def _save_batch(batch_idx, labels, strs, device_outputs, host_outputs, copy_done):
+        if copy_done is not None:
+            copy_done.synchronize()
+        batch_saves = []
+        shard = {}
+        for i, label in enumerate(labels):
+            result = {"label": label}
+            # Call clone on tensors to ensure tensors are not views into a larger representation
+            # See https://github.com/pytorch/pytorch/issues/1995
+            if "per_tok" in args.include:
+                result["representations"] = {
+                    layer: host_outputs["per_tok"][i][k].clone()
+                    for k, layer in enumerate(layers)
+                }
+            if "mean" in args.include:
+                result["mean_representations"] = {
+                    layer: host_outputs["mean"][k, i].clone()
+                    for k, layer in enumerate(layers)
+                }
+            if "bos" in args.include:
+                result["bos_representations"] = {
+                    layer: host_outputs["bos"][k, i].clone()
+                    for k, layer in enumerate(layers)
+                }
+            if return_contacts:
+                result["contacts"] = host_outputs["contacts"][i]
+
+            if args.shards:
+                shard[label] = result
+                continue
+
+            output_file = args.output_dir / f"{label}.pt"
+            if output_file.parent not in created_dirs:
+                output_file.parent.mkdir(parents=True, exist_ok=True)
+                created_dirs.add(output_file.parent)
+            batch_saves.append(writer.submit(torch.save, result, output_file))
 
-    with torch.no_grad():
+        if args.shards:
+            shard_file = args.output_dir / f"shard_{batch_idx:05d}.pt"
+            batch_saves.append(writer.submit(torch.save, shard, shard_file))
+
+        pending_saves.append(batch_saves)
+        while len(pending_saves) > MAX_PENDING_SAVE_BATCHES:
+            for future in pending_saves.popleft():
+                future.result()
+
+    pending_batch = None
+    with torch.inference_mode():
         for batch_idx, (labels, strs, toks) in enumerate(data_loader):
             print(
                 f"Processing {batch_idx + 1} of {len(batches)} batches ({toks.size(0)} sequences)"
@@ -88,44 +210,75 @@ def main(args):
             if torch.cuda.is_available() and not args.nogpu:
                 toks = toks.to(device="cuda", non_blocking=True)
 
-            out = model(toks, repr_layers=repr_layers, return_contacts=return_contacts)
+            out = model(
+                toks,
+                repr_layers=repr_layers,
+                return_contacts=return_contacts,
+                return_logits=False,
+            )
 
-            logits = out["logits"].to(device="cpu")
-            representations = {
-                layer: t.to(device="cpu") for layer, t in out["representations"].items()
-            }
+            # Slice and reduce on the device so only the residues that are saved get copied back.
+            # The requested layers are stacked so each step is a single op over all of them.
+            reps = [out["representations"][layer] for layer in layers]
+            # L x B x T x D; a single layer is viewed rather than copied
+            rep_stack = torch.stack(reps) if len(reps) > 1 else reps[0].unsqueeze(0)
+            device_outputs = {}
+            if "per_tok" in args.include:
+                device_outputs["per_tok"] = [
+                    rep_stack[:, i, 1 : len(strs[i]) + 1].to(
+                        dtype=torch.float32, memory_format=torch.contiguous_format, copy=True
+                    )
+                    for i in range(len(strs))
+                ]
+            if "mean" in args.include:
+                # Built from toks so it stays on the device; a host-side lengths tensor would
+                # need a copy that blocks until the forward pass has finished
+                residue_mask = (
+                    (toks != alphabet.padding_idx)
+                    & (toks != alphabet.cls_idx)
+                    & (toks != alphabet.eos_idx)
+                )  # B x T
+                # Contracting with per-residue weights of 1 / length gives the mean without an
+                # L x B x T x D temporary, and keeps half-precision sums from overflowing
+                weights = residue_mask / residue_mask.sum(1, keepdim=True)
+                device_outputs["mean"] = torch.einsum(
+                    "lbtd,bt->lbd", rep_stack, weights.to(rep_stack.dtype)
+                ).float()
+            if "bos" in args.include:
+                device_outputs["bos"] = rep_stack[:, :, 0].float()
             if return_contacts:
-                contacts = out["contacts"].to(device="cpu")
-
-            for i, label in enumerate(labels):
-                args.output_file = (
-                    args.output_dir / f"{label}.pt"
-                )
-                args.output_file.parent.mkdir(parents=True, exist_ok=True)
-                result = {"label": label}
-                # Call clone on tensors to ensure tensors are not views into a larger representation
-                # See https://github.com/pytorch/pytorch/issues/1995
-                if "per_tok" in args.include:
-                    result["representations"] = {
-                        layer: t[i, 1 : len(strs[i]) + 1].clone()
-                        for layer, t in representations.items()
-                    }
-                if "mean" in args.include:
-                    result["mean_representations"] = {
-                        layer: t[i, 1 : len(strs[i]) + 1].mean(0).clone()
-                        for layer, t in representations.items()
-                    }
-                if "bos" in args.include:
-                    result["bos_representations"] = {
-                        layer: t[i, 0].clone() for layer, t in representations.items()
-                    }
-                if return_contacts:
-                    result["contacts"] = contacts[i, :len(strs[i]), :len(strs[i])].clone()
-
-                torch.save(
-                    result,
-                    args.output_file,
-                )
+                device_outputs["contacts"] = [
+                    out["contacts"][i, : len(strs[i]), : len(strs[i])].to(
+                        dtype=torch.float32, memory_format=torch.contiguous_format, copy=True
+                    )
+                    for i in range(len(strs))
+                ]
+
+            if copy_stream is not None:
+                copy_stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(copy_stream):
+                    host_outputs = _to_host(device_outputs)
+                copy_done = copy_stream.record_event()
+            else:
+                host_outputs, copy_done = device_outputs, None
+
+            # Without contacts nothing above reads a device value back (the model always passes
+            # padding_mask rather than checking it on the host), so this batch's forward pass and
+            # copies are only queued when the previous batch is saved below. With contacts the
+            # contact head checks the cls/eos tokens on the host, which waits for this batch's
+            # transformer layers to finish first. device_outputs is kept alive until its copy
+            # has completed.
+            if pending_batch is not None:
+                _save_batch(*pending_batch)
+            pending_batch = (batch_idx, labels, strs, device_outputs, host_outputs, copy_done)
+
+        if pending_batch is not None:
+            _save_batch(*pending_batch)
+
+    writer.shutdown(wait=True)
+    for batch_saves in pending_saves:
+        for future in batch_saves:
+            future.result()  # re-raise any error from a background save
 
 
 if __name__ == "__main__":